@@ -7,14 +7,458 @@
 from __future__ import division
 from __future__ import print_function
 
+import numbers
+import threading
+
+import numpy as np
+from joblib import Parallel
+from joblib.parallel import delayed
+from numba import njit, prange
+from scipy import linalg
+from scipy.stats import chi2
+from scipy.stats import norm
+from scipy.stats import rankdata
 from sklearn.covariance import MinCovDet
+from sklearn.covariance import empirical_covariance
+from sklearn.utils import check_random_state
 from sklearn.utils.validation import check_is_fitted
 from sklearn.utils.validation import check_array
 
+from ..utils.utility import check_parameter
 from .base import BaseDetector
+from .sklearn_base import _get_n_jobs
 
 __all__ = ['MCD']
 
+# inputs with at most this many features are scored with the numba kernel,
+# which outperforms BLAS dispatch on narrow inputs
+_NUMBA_MAX_FEATURES = 64
+
+# batches with fewer samples are scored with the serial version of the numba
+# kernel, as starting the parallel threads dominates on small batches
+_SMALL_BATCH_SIZE = 32
+
+# size in bytes of the row blocks scored at once on wider inputs
+_BLOCK_BYTES = 256 * 1024
+
+MAX_INT = np.iinfo(np.int32).max
+
+# consistency factors of the MCD covariance, keyed by (n_features, alpha)
+_CONSISTENCY_FACTORS = {}
+
+
+@njit(parallel=True, fastmath=True)
+def _maha_kernel(X, mu, VI, out):  # pragma: no cover
+    """Internal function to calculate the squared mahalanobis distance of
+    each sample with numba. It is excluded from coverage test as it is
+    compiled.
+
+    Each sample is centered once into a contiguous buffer, and only the
+    lower triangle of the symmetric precision matrix is visited, which
+    halves the number of multiply-adds of the quadratic form.
+
+    Parameters
+    ----------
+    X : numpy array of shape (n_samples, n_features)
+        The input samples.
+
+    mu : numpy array of shape (n_features,)
+        The location.
+
+    VI : numpy array of shape (n_features, n_features)
+        The precision matrix.
+
+    out : numpy array of shape (n_samples,)
+        The output array the distances are written to.
+    """
+    n, p = X.shape
+    for i in prange(n):
+        d = np.empty(p)
+        for k in range(p):
+            d[k] = X[i, k] - mu[k]
+
+        s = 0.0
+        for j in range(p):
+            t = 0.0
+            for k in range(j):
+                t += VI[j, k] * d[k]
+            s += d[j] * (VI[j, j] * d[j] + 2.0 * t)
+        out[i] = s
+
+
+# serial version of the kernel for low latency scoring of small batches
+_maha_kernel_serial = njit(fastmath=True)(_maha_kernel.py_func)
+
+# the default workqueue threading layer of numba aborts the process when
+# parallel functions are launched from several threads at once, so the
+# launches of the parallel kernel are serialized
+_maha_kernel_lock = threading.Lock()
+
+
+def _fit_min_cov_det(X, store_precision, assume_centered, support_fraction,
+                     random_state, return_logdet=False):
+    """Internal function to fit a single scikit-learn MinCovDet estimator.
+    Used to fit several estimators with different random states in parallel.
+
+    Returns
+    -------
+    detector : MinCovDet
+        The fitted estimator.
+
+    raw_logdet : float
+        The log determinant of the covariance of the raw support, i.e. the
+        objective minimized by the MCD. Only returned if ``return_logdet``
+        is True.
+    """
+    detector = MinCovDet(store_precision=store_precision,
+                         assume_centered=assume_centered,
+                         support_fraction=support_fraction,
+                         random_state=random_state)
+    detector.fit(X)
+    if not return_logdet:
+        return detector
+
+    raw_covariance = empirical_covariance(X[detector.raw_support_],
+                                          assume_centered=assume_centered)
+    return detector, np.linalg.slogdet(raw_covariance)[1]
+
+
+def _consistency_factor(n_features, alpha):
+    """Internal function to compute the factor that makes the covariance of
+    the alpha fraction of samples closest to the center consistent at normal
+    models, i.e. alpha / F_{chi2(p + 2)}(chi2(p).ppf(alpha)). The factor
+    only depends on its arguments, so it is computed once and cached.
+
+    Parameters
+    ----------
+    n_features : int
+        The number of features.
+
+    alpha : float in (0, 1]
+        The fraction of samples the covariance is computed from.
+
+    Returns
+    -------
+    factor : float
+        The consistency factor.
+    """
+    key = (n_features, alpha)
+    if key not in _CONSISTENCY_FACTORS:
+        _CONSISTENCY_FACTORS[key] = alpha / chi2(n_features + 2).cdf(
+            chi2(n_features).ppf(alpha))
+    return _CONSISTENCY_FACTORS[key]
+
+
+def _mad(X):
+    """Internal function to compute the median absolute deviation around
+    zero of each column of X, scaled to be consistent with the standard
+    deviation at the normal distribution.
+    """
+    return 1.4826 * np.median(np.abs(X), axis=0)
+
+
+def _corrcoef(X):
+    """Internal function to compute the correlation matrix of the columns
+    of X. Unlike :func:`numpy.corrcoef`, constant columns get zero
+    correlations instead of NaN.
+    """
+    covariance = np.atleast_2d(np.cov(X, rowvar=False))
+    std = np.sqrt(np.diag(covariance))
+    std[std == 0] = 1.
+    return covariance / np.outer(std, std)
+
+
+def _det_initial_scatters(Z):
+    """Internal function to compute the six preliminary scatter estimates
+    of DetMCD on standardized samples. See :cite:`hubert2012deterministic`
+    for details.
+
+    Parameters
+    ----------
+    Z : numpy array of shape (n_samples, n_features)
+        The samples, centered by their median and scaled by their MAD.
+
+    Returns
+    -------
+    scatters : list of numpy arrays of shape (n_features, n_features)
+        The preliminary scatter estimates.
+    """
+    n_samples, n_features = Z.shape
+    ranks = np.apply_along_axis(rankdata, 0, Z)
+    norms = np.sqrt(np.einsum('ij,ij->i', Z, Z))
+
+    # hyperbolic tangent of the standardized samples
+    S1 = _corrcoef(np.tanh(Z))
+
+    # Spearman rank correlation
+    S2 = _corrcoef(ranks)
+
+    # normal scores of the ranks
+    S3 = _corrcoef(norm.ppf((ranks - 1. / 3) / (n_samples + 1. / 3)))
+
+    # spatial sign covariance
+    K = Z / np.where(norms > 0, norms, 1.)[:, np.newaxis]
+    S4 = np.dot(K.T, K) / n_samples
+
+    # first step of BACON, the half of the samples closest to the median
+    h0 = int(np.ceil(n_samples / 2.))
+    S5 = np.atleast_2d(
+        np.cov(Z[np.argpartition(norms, h0 - 1)[:h0]], rowvar=False))
+
+    # raw OGK, pairwise covariances from the MAD of sums and differences
+    S6 = np.empty((n_features, n_features))
+    for j in range(n_features):
+        S6[j] = (_mad(Z[:, [j]] + Z) ** 2 - _mad(Z[:, [j]] - Z) ** 2) / 4.
+
+    return [S1, S2, S3, S4, S5, S6]
+
+
+def _det_initial_supports(Z):
+    """Internal function to derive the initial subsets of DetMCD, made of
+    the ceil(n_samples / 2) samples closest to each preliminary estimate.
+
+    Parameters
+    ----------
+    Z : numpy array of shape (n_samples, n_features)
+        The samples, centered by their median and scaled by their MAD.
+
+    Returns
+    -------
+    supports : list of numpy arrays of shape (ceil(n_samples / 2),)
+        The indices of the samples in each initial subset.
+    """
+    h0 = int(np.ceil(Z.shape[0] / 2.))
+    supports = []
+    for S in _det_initial_scatters(Z):
+        # Rebuild the scatter from the robust scale of the samples projected
+        # on its eigenvectors, which makes it positive semi-definite
+        _, E = linalg.eigh(S)
+        scale = _mad(np.dot(Z, E))
+        inv_scale = np.zeros_like(scale)
+        inv_scale[scale > 0] = 1. / scale[scale > 0]
+
+        # Whiten the samples with the inverse square root of the scatter
+        # and take the coordinatewise median as the location
+        W = np.dot(np.dot(Z, E) * inv_scale, E.T)
+        dist = np.sum((W - np.median(W, axis=0)) ** 2, axis=1)
+        supports.append(np.argpartition(dist, h0 - 1)[:h0])
+
+    return supports
+
+
+def _c_steps(X, supports, n_support, assume_centered, max_iter=30,
+             tol=1e-8):
+    """Internal function to run concentration steps (C-steps) from several
+    initial subsets at once, until the determinant of each covariance stops
+    decreasing, or its log decreases by less than a relative tolerance.
+
+    The estimates of all the subsets are stacked, so that the distances of
+    the samples to every estimate are computed in a single batched pass
+    over X.
+
+    Parameters
+    ----------
+    X : numpy array of shape (n_samples, n_features)
+        The input samples.
+
+    supports : numpy array of shape (n_subsets, n_initial)
+        The indices of the samples in each initial subset.
+
+    n_support : int
+        The number of samples in the support of the estimates.
+
+    assume_centered : bool
+        Whether the location is fixed at zero.
+
+    max_iter : int, optional (default=30)
+        The maximum number of C-steps.
+
+    tol : float, optional (default=1e-8)
+        The relative decrease of the log determinant below which the C-steps
+        are considered converged.
+
+    Returns
+    -------
+    locations : numpy array of shape (n_subsets, n_features)
+        The location of each support.
+
+    covariances : numpy array of shape (n_subsets, n_features, n_features)
+        The covariance of each support.
+
+    supports : numpy array of shape (n_subsets, n_support)
+        The indices of the samples in each support.
+
+    dists : numpy array of shape (n_subsets, n_samples)
+        The squared mahalanobis distances of the samples to each estimate.
+
+    logdets : numpy array of shape (n_subsets,)
+        The log determinant of each covariance.
+    """
+
+    def _estimate(supports):
+        X_supports = X[supports]
+        if assume_centered:
+            locations = np.zeros((len(supports), X.shape[1]))
+        else:
+            locations = X_supports.mean(axis=1)
+        X_supports = X_supports - locations[:, np.newaxis, :]
+        covariances = np.matmul(X_supports.transpose(0, 2, 1),
+                                X_supports) / supports.shape[1]
+        precisions = np.array([linalg.pinvh(c) for c in covariances])
+        diff = X[np.newaxis, :, :] - locations[:, np.newaxis, :]
+        dists = np.einsum('knp,knp->kn', np.matmul(diff, precisions), diff)
+        return (locations, covariances, dists,
+                np.linalg.slogdet(covariances)[1])
+
+    def _select(dists):
+        # only the n_support smallest distances are needed, which partial
+        # selection finds in linear time
+        return np.argpartition(dists, n_support - 1, axis=1)[:, :n_support]
+
+    # The initial subsets may not have n_support samples, so the first
+    # C-step is always taken
+    _, _, dists, _ = _estimate(supports)
+    supports = _select(dists)
+    locations, covariances, dists, logdets = _estimate(supports)
+
+    # an exact fit cannot be improved any further
+    active = ~np.isinf(logdets)
+    for _ in range(max_iter - 1):
+        if not active.any():
+            break
+
+        ind = np.flatnonzero(active)
+        new_supports = _select(dists[ind])
+        new_locations, new_covariances, new_dists, new_logdets = _estimate(
+            new_supports)
+
+        # C-steps monotonically decrease the determinant, stop as soon as
+        # it reaches a plateau
+        improved = new_logdets < logdets[ind]
+        converged = np.logical_or(
+            ~improved, logdets[ind] - new_logdets < tol * np.abs(logdets[ind]))
+        converged = np.logical_or(converged, np.isinf(new_logdets))
+
+        updated = ind[improved]
+        supports[updated] = new_supports[improved]
+        locations[updated] = new_locations[improved]
+        covariances[updated] = new_covariances[improved]
+        dists[updated] = new_dists[improved]
+        logdets[updated] = new_logdets[improved]
+        active[ind[converged]] = False
+
+    return locations, covariances, supports, dists, logdets
+
+
+def _fit_det_mcd(X, store_precision, assume_centered, support_fraction):
+    """Internal function to fit the MCD with the deterministic DetMCD
+    algorithm. The result is stored in a scikit-learn MinCovDet estimator,
+    so that it exposes the same attributes as a FastMCD fit.
+
+    Returns
+    -------
+    detector : MinCovDet
+        The fitted estimator.
+    """
+    n_samples, n_features = X.shape
+    if support_fraction is None:
+        n_support = int(np.ceil(0.5 * (n_samples + n_features + 1)))
+    else:
+        n_support = int(support_fraction * n_samples)
+    # the support cannot be larger than the data, e.g. when n_features is
+    # not smaller than n_samples
+    n_support = min(n_support, n_samples)
+
+    # Standardize the samples by their median and MAD. The C-steps run on
+    # the original samples, since the MCD is affine equivariant
+    if assume_centered:
+        Z = X.copy()
+    else:
+        Z = X - np.median(X, axis=0)
+    scale = _mad(Z)
+    scale[scale == 0] = 1.
+    Z /= scale
+
+    # Keep the C-step fit with the smallest covariance determinant
+    locations, covariances, supports, dists, logdets = _c_steps(
+        X, np.array(_det_initial_supports(Z)), n_support, assume_centered)
+    best = np.argmin(logdets)
+    raw_location = locations[best]
+    raw_covariance = covariances[best]
+    raw_support = supports[best]
+    raw_dist = dists[best]
+
+    raw_support_mask = np.zeros(n_samples, dtype=bool)
+    raw_support_mask[raw_support] = True
+
+    # Check that the covariance of the support data is not equal to 0,
+    # otherwise the distances are 0 and so is the correction
+    median_dist = np.median(raw_dist)
+    if n_support < n_samples and (np.allclose(raw_covariance, 0) or
+                                  median_dist == 0):
+        raise ValueError("The covariance matrix of the support data "
+                         "is equal to 0, try to increase support_fraction")
+
+    # Obtain consistency at normal models with the same empirical correction
+    # as MinCovDet. The raw distances come from the C-steps, so no pass
+    # over X is needed
+    correction = median_dist / chi2(n_features).isf(0.5)
+    raw_covariance = raw_covariance * correction
+    raw_dist = raw_dist / correction
+
+    # Reweight in a single sweep: the raw distances give the weights, and
+    # the location and covariance are computed from the retained samples
+    # only. The reweighted covariance is made consistent at normal models
+    mask = raw_dist < chi2(n_features).isf(0.025)
+    X_support = X[mask]
+    if assume_centered:
+        location = np.zeros(n_features)
+    else:
+        location = X_support.mean(axis=0)
+    covariance = empirical_covariance(X_support,
+                                      assume_centered=assume_centered)
+    covariance *= _consistency_factor(n_features, 0.975)
+
+    Z = np.dot(X - location, _pinv_sqrt(covariance))
+    dist = np.einsum('ij,ij->i', Z, Z)
+
+    # Store the estimates with the attributes of a fitted MinCovDet
+    detector = MinCovDet(store_precision=store_precision,
+                         assume_centered=assume_centered,
+                         support_fraction=support_fraction)
+    detector.n_features_in_ = n_features
+    detector.raw_location_ = raw_location
+    detector.raw_covariance_ = raw_covariance
+    detector.raw_support_ = raw_support_mask
+    detector._set_covariance(covariance)
+    detector.location_ = location
+    detector.support_ = mask
+    detector.dist_ = dist
+    return detector
+
+
+def _pinv_sqrt(covariance):
+    """Internal function to compute a factor W of the pseudo inverse of
+    a symmetric positive semi-definite matrix, i.e. W W^T = pinv(covariance).
+    Eigenvalues below the cutoff used by :func:`scipy.linalg.pinvh` are
+    discarded, so that rank-deficient covariance matrices are supported.
+
+    Parameters
+    ----------
+    covariance : numpy array of shape (n_features, n_features)
+        The covariance matrix.
+
+    Returns
+    -------
+    W : numpy array of shape (n_features, n_features)
+        The factor of the pseudo inverse.
+    """
+    s, U = linalg.eigh(covariance)
+    cutoff = np.max(np.abs(s)) * covariance.shape[0] * np.finfo(s.dtype).eps
+    inv_sqrt = np.zeros_like(s)
+    inv_sqrt[s > cutoff] = 1. / np.sqrt(s[s > cutoff])
+    return U * inv_sqrt
+
 
 class MCD(BaseDetector):
     """Detecting outliers in a Gaussian distributed dataset using
@@ -64,6 +508,31 @@ class MCD(BaseDetector):
         If None, the random number generator is the RandomState instance used
         by `np.random`.
 
+    n_jobs : int, optional (default=1)
+        The number of jobs to run in parallel for fitting the ``n_init``
+        FastMCD estimators. It does not change the fitted model.
+        If -1, then the number of jobs is set to the number of cores.
+        Only used when ``method='fastmcd'``.
+
+    method : str, optional (default='fastmcd')
+        The algorithm used to compute the raw MCD estimate.
+
+        - 'fastmcd': the FastMCD algorithm from random initial subsets, as
+          implemented by scikit-learn MinCovDet.
+        - 'det': the deterministic DetMCD algorithm, which starts from six
+          robust preliminary estimates instead of random subsets. It is
+          much faster on large datasets and does not depend on
+          ``random_state``. See :cite:`hubert2012deterministic` for details.
+          Unlike 'fastmcd', its reweighted covariance is also multiplied by
+          the consistency factor of the 0.975 reweighting quantile, so
+          ``covariance_``, ``dist_`` and the outlier scores are not on the
+          same scale across the two methods.
+
+    n_init : int, optional (default=1)
+        The number of times FastMCD is run from different random initial
+        subsets. The fit with the smallest determinant of the raw support
+        covariance is kept. Only used when ``method='fastmcd'``.
+
     Attributes
     ----------
     raw_location_ : array-like, shape (n_features,)
@@ -112,12 +581,15 @@ class MCD(BaseDetector):
 
     def __init__(self, contamination=0.1, store_precision=True,
                  assume_centered=False, support_fraction=None,
-                 random_state=None):
+                 random_state=None, n_jobs=1, method='fastmcd', n_init=1):
         super(MCD, self).__init__(contamination=contamination)
         self.store_precision = store_precision
         self.assume_centered = assume_centered
         self.support_fraction = support_fraction
         self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.method = method
+        self.n_init = n_init
 
     # noinspection PyIncorrectDocstring
     def fit(self, X, y=None):
@@ -137,14 +609,42 @@ class MCD(BaseDetector):
             Fitted estimator.
         """
         # Validate inputs X and y (optional)
-        X = check_array(X)
+        X = check_array(X, dtype=np.float64, order='C', copy=False)
         self._set_n_classes(y)
 
-        self.detector_ = MinCovDet(store_precision=self.store_precision,
-                                   assume_centered=self.assume_centered,
-                                   support_fraction=self.support_fraction,
-                                   random_state=self.random_state)
-        self.detector_.fit(X=X, y=y)
+        if self.method not in ('fastmcd', 'det'):
+            raise ValueError(self.method, "is not a valid method")
+
+        if not isinstance(self.n_init, (numbers.Integral, np.integer)):
+            raise TypeError(
+                'n_init must be an integer. Got {}'.format(type(self.n_init)))
+        check_parameter(self.n_init, low=1, param_name='n_init',
+                        include_left=True)
+
+        if self.method == 'det':
+            self.detector_ = _fit_det_mcd(
+                X, self.store_precision, self.assume_centered,
+                self.support_fraction)
+        elif self.n_init == 1:
+            self.detector_ = _fit_min_cov_det(
+                X, self.store_precision, self.assume_centered,
+                self.support_fraction, self.random_state)
+        else:
+            # Each run of FastMCD starts from its own random initial subsets,
+            # and the runs are distributed over the jobs. Keep the fit with
+            # the smallest raw covariance determinant
+            random_state = check_random_state(self.random_state)
+            seeds = random_state.randint(MAX_INT, size=self.n_init)
+            n_jobs = min(_get_n_jobs(self.n_jobs), self.n_init)
+            fits = Parallel(n_jobs=n_jobs, backend='loky')(
+                delayed(_fit_min_cov_det)(
+                    X, self.store_precision, self.assume_centered,
+                    self.support_fraction, seed, return_logdet=True)
+                for seed in seeds)
+            self.detector_ = min(fits, key=lambda fit: fit[1])[0]
+
+        # Invalidate the scoring parameters cached from a previous fit
+        self._scoring_cache = None
 
         # Use mahalanabis distance as the outlier score
         self.decision_scores_ = self.detector_.dist_
@@ -170,10 +670,83 @@ class MCD(BaseDetector):
             The anomaly score of the input samples.
         """
         check_is_fitted(self, ['decision_scores_', 'threshold_', 'labels_'])
-        X = check_array(X)
+        X = check_array(X, dtype=[np.float64, np.float32], order='C',
+                        copy=False)
+
+        mu, VI, W = self._get_scoring_params(X.dtype)
+        if X.shape[1] != mu.shape[0]:
+            raise ValueError("X has %d features, but MCD is expecting %d "
+                             "features as input." % (X.shape[1], mu.shape[0]))
+
+        # Low dimensional samples are scored with the compiled kernel
+        if X.shape[1] <= _NUMBA_MAX_FEATURES:
+            out = np.empty(X.shape[0])
+            if X.shape[0] < _SMALL_BATCH_SIZE:
+                _maha_kernel_serial(X, mu, VI, out)
+            else:
+                with _maha_kernel_lock:
+                    _maha_kernel(X, mu, VI, out)
+            return out
+
+        # Otherwise compute the (squared) mahalanobis distance of the samples
+        # as ||(x - mu) W||^2, with W W^T the pseudo inverse of the robust
+        # covariance from its eigen decomposition, which also supports
+        # rank-deficient covariances. The sum of squares is always
+        # accumulated in float64, also for float32 input.
+        # The samples are processed in blocks of rows, so that the centered
+        # and projected intermediates stay in cache instead of being
+        # materialized for the whole input
+        n_samples, n_features = X.shape
+        block_size = max(1, _BLOCK_BYTES // (n_features * X.itemsize))
+        out = np.empty(n_samples)
+        for start in range(0, n_samples, block_size):
+            Z = np.dot(X[start:start + block_size] - mu, W)
+            out[start:start + block_size] = np.einsum(
+                'ij,ij->i', Z, Z, dtype=np.float64)
+        return out
+
+    def _get_scoring_params(self, dtype=np.float64):
+        """Internal function to lazily build the location, precision and
+        covariance factor used by :meth:`decision_function`. They are
+        computed on first use and reused until the fitted covariance
+        changes, so repeated scoring does not redo the matrix inversion.
+
+        Parameters
+        ----------
+        dtype : numpy dtype, optional (default=np.float64)
+            The dtype of the samples to score. For float32 samples, a float32
+            copy of the parameters is returned so that the input is not
+            upcast.
 
-        # Computer mahalanobis distance of the samples
-        return self.detector_.mahalanobis(X)
+        Returns
+        -------
+        params : tuple of (mu, VI, W)
+            The location, the precision and the factor of the pseudo inverse
+            of the covariance.
+        """
+        # Bind the fitted estimator once, rather than going through the
+        # forwarding properties of this class
+        detector = self.detector_
+        covariance = detector.covariance_
+
+        # The cache is a single (covariance, params, params32) tuple that is
+        # only read through a local reference and replaced as a whole, so
+        # concurrent calls from several threads never see it half updated
+        cache = getattr(self, '_scoring_cache', None)
+        if cache is None or cache[0] is not covariance:
+            params = (detector.location_, detector.get_precision(),
+                      _pinv_sqrt(covariance))
+            cache = (covariance, params, None)
+            self._scoring_cache = cache
+
+        if dtype != np.float32:
+            return cache[1]
+
+        if cache[2] is None:
+            cache = (covariance, cache[1],
+                     tuple(param.astype(np.float32) for param in cache[1]))
+            self._scoring_cache = cache
+        return cache[2]
 
     @property
     def raw_location_(self):
@@ -3,7 +3,9 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import subprocess
 import sys
+import threading
 
 import unittest
 # noinspection PyProtectedMember
@@ -12,17 +14,48 @@ from numpy.testing import assert_array_less
 from numpy.testing import assert_equal
 from numpy.testing import assert_raises
 
+from scipy import linalg
+from sklearn.covariance import empirical_covariance
 from sklearn.metrics import roc_auc_score
 from scipy.stats import rankdata
 
+import numpy as np
+
 # temporary solution for relative imports in case pyod is not installed
 # if pyod is installed, no need to use the following line
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from pyod.models.mcd import MCD
+from pyod.models.mcd import _c_steps
 from pyod.utils.data import generate_data
 
 
+def _c_step_reference(X, support, n_support, max_iter=100):
+    """Reference C-steps of a single subset, run until the determinant
+    stops decreasing.
+    """
+
+    def _estimate(support):
+        location = X[support].mean(axis=0)
+        covariance = empirical_covariance(X[support])
+        X_centered = X - location
+        dist = np.sum(
+            np.dot(X_centered, linalg.pinvh(covariance)) * X_centered, axis=1)
+        return location, covariance, dist, np.linalg.slogdet(covariance)[1]
+
+    _, _, dist, _ = _estimate(support)
+    support = np.argsort(dist)[:n_support]
+    location, covariance, dist, logdet = _estimate(support)
+    for _ in range(max_iter):
+        new_support = np.argsort(dist)[:n_support]
+        new_estimate = _estimate(new_support)
+        if not new_estimate[3] < logdet:
+            break
+        support = new_support
+        location, covariance, dist, logdet = new_estimate
+    return location, covariance, support, logdet
+
+
 class TestMCD(unittest.TestCase):
     def setUp(self):
         self.n_train = 200
@@ -74,6 +107,265 @@ class TestMCD(unittest.TestCase):
         # check performance
         assert (roc_auc_score(self.y_test, pred_scores) >= self.roc_floor)
 
+    def test_prediction_scores_consistency(self):
+        # scores on the training data should match the fitted scores
+        assert_allclose(self.clf.decision_function(self.X_train),
+                        self.clf.decision_scores_)
+
+        # and agree with the reference implementation of scikit-learn
+        assert_allclose(self.clf.decision_function(self.X_test),
+                        self.clf.detector_.mahalanobis(self.X_test))
+
+    def test_prediction_scores_high_dimensional(self):
+        # wider inputs are not scored by the numba kernel
+        X_train, _, X_test, _ = generate_data(
+            n_train=self.n_train, n_test=self.n_test, n_features=80,
+            contamination=self.contamination, random_state=42)
+        clf = MCD(contamination=self.contamination, random_state=42)
+        clf.fit(X_train)
+
+        assert_allclose(clf.decision_function(X_train),
+                        clf.decision_scores_)
+        assert_allclose(clf.decision_function(X_test),
+                        clf.detector_.mahalanobis(X_test))
+
+        # large inputs are scored in several blocks of rows
+        X_large = np.tile(X_test, (10, 1))
+        assert_allclose(clf.decision_function(X_large),
+                        np.tile(clf.decision_function(X_test), 10))
+
+    def test_prediction_scores_rank_deficient(self):
+        # a duplicated feature makes the robust covariance singular
+        X_train, _, X_test, _ = generate_data(
+            n_train=self.n_train, n_test=self.n_test, n_features=79,
+            contamination=self.contamination, random_state=42)
+        X_train = np.hstack([X_train, X_train[:, :1]])
+        X_test = np.hstack([X_test, X_test[:, :1]])
+        clf = MCD(contamination=self.contamination, random_state=42)
+        clf.fit(X_train)
+
+        assert_allclose(clf.decision_function(X_train),
+                        clf.decision_scores_)
+        assert_allclose(clf.decision_function(X_test),
+                        clf.detector_.mahalanobis(X_test))
+
+    def test_prediction_scores_threads(self):
+        # concurrent scoring from a freshly fitted model, while the scoring
+        # parameters are being cached, gives the same scores
+        clf = MCD(contamination=self.contamination, random_state=42)
+        clf.fit(self.X_train)
+        X_tests = [self.X_test, self.X_test.astype(np.float32)] * 4
+        results = [None] * len(X_tests)
+
+        def score(i):
+            results[i] = clf.decision_function(X_tests[i])
+
+        threads = [threading.Thread(target=score, args=(i,))
+                   for i in range(len(X_tests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for pred_scores in results:
+            assert_allclose(pred_scores,
+                            clf.detector_.mahalanobis(self.X_test),
+                            rtol=1e-4)
+
+    def test_prediction_scores_threads_workqueue(self):
+        # numba's workqueue threading layer aborts the whole process on
+        # concurrent parallel launches, so run the threads in a subprocess
+        # forced to use it, independently of the layers installed here
+        script = '\n'.join([
+            'import threading',
+            'import numpy as np',
+            'from pyod.models.mcd import MCD',
+            'X = np.random.RandomState(42).randn(20000, 8)',
+            'clf = MCD(random_state=42).fit(X[:1000])',
+            'expected = clf.decision_function(X)',
+            'results = [None] * 8',
+            'def score(i):',
+            '    results[i] = clf.decision_function(X)',
+            'threads = [threading.Thread(target=score, args=(i,))',
+            '           for i in range(8)]',
+            '[thread.start() for thread in threads]',
+            '[thread.join() for thread in threads]',
+            'assert all(np.allclose(r, expected) for r in results)',
+        ])
+        env = dict(os.environ, NUMBA_THREADING_LAYER='workqueue')
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                          '..')),
+             env.get('PYTHONPATH', '')])
+        assert_equal(subprocess.call([sys.executable, '-c', script],
+                                     env=env), 0)
+
+    def test_prediction_scores_refit(self):
+        # cached scoring parameters are discarded when the model is refitted
+        clf = MCD(contamination=self.contamination, random_state=42)
+        clf.fit(self.X_train)
+        clf.decision_function(self.X_test)
+
+        clf.fit(self.X_test)
+        assert_allclose(clf.decision_function(self.X_test),
+                        clf.decision_scores_)
+
+    def test_prediction_scores_small_batch(self):
+        # small batches are scored by a different kernel
+        pred_scores = self.clf.decision_function(self.X_test)
+        for i in range(5):
+            assert_allclose(self.clf.decision_function(self.X_test[[i]]),
+                            pred_scores[[i]])
+
+    def test_prediction_scores_n_features(self):
+        # inputs with too few or too many features are rejected, for both
+        # the numba and the BLAS scoring paths
+        for n_features in (self.X_train.shape[1] - 1,
+                           self.X_train.shape[1] + 1, 80):
+            with assert_raises(ValueError):
+                self.clf.decision_function(np.ones((5, n_features)))
+            with assert_raises(ValueError):
+                self.clf.decision_function(np.ones((50, n_features)))
+
+    def test_prediction_scores_float32(self):
+        pred_scores = self.clf.decision_function(self.X_test)
+        pred_scores32 = self.clf.decision_function(
+            self.X_test.astype(np.float32))
+
+        assert_equal(pred_scores32.dtype, np.float64)
+        assert_allclose(pred_scores32, pred_scores, rtol=1e-4)
+
+    def test_parallel_fit(self):
+        clf = MCD(contamination=self.contamination, random_state=42,
+                  n_init=3, n_jobs=2)
+        clf.fit(self.X_train)
+
+        assert_equal(len(clf.decision_scores_), self.X_train.shape[0])
+        assert_allclose(clf.decision_function(self.X_train),
+                        clf.decision_scores_)
+
+        pred_scores = clf.decision_function(self.X_test)
+        assert (roc_auc_score(self.y_test, pred_scores) >= self.roc_floor)
+
+        # the number of jobs does not change the fitted model
+        clf_serial = MCD(contamination=self.contamination, random_state=42,
+                         n_init=3, n_jobs=1)
+        clf_serial.fit(self.X_train)
+        assert_allclose(clf_serial.decision_scores_, clf.decision_scores_)
+
+        clf_jobs = MCD(contamination=self.contamination, random_state=42,
+                       n_jobs=2)
+        clf_jobs.fit(self.X_train)
+        assert_allclose(clf_jobs.decision_scores_,
+                        self.clf.decision_scores_)
+
+    def test_n_init_parameter(self):
+        with assert_raises(ValueError):
+            MCD(n_init=0).fit(self.X_train)
+        with assert_raises(TypeError):
+            MCD(n_init=2.0).fit(self.X_train)
+
+    def test_det_method(self):
+        clf = MCD(contamination=self.contamination, method='det')
+        clf.fit(self.X_train)
+
+        assert_equal(len(clf.decision_scores_), self.X_train.shape[0])
+        assert_equal(clf.raw_support_.shape, (self.X_train.shape[0],))
+        assert_allclose(clf.decision_function(self.X_train),
+                        clf.decision_scores_)
+
+        pred_scores = clf.decision_function(self.X_test)
+        assert (roc_auc_score(self.y_test, pred_scores) >= self.roc_floor)
+
+        # the deterministic algorithm does not depend on the random state
+        clf_other = MCD(contamination=self.contamination, method='det',
+                        random_state=0)
+        clf_other.fit(self.X_train)
+        assert_allclose(clf_other.decision_scores_, clf.decision_scores_)
+
+    def test_det_method_wide(self):
+        # the default support is clipped to the number of samples when
+        # there are at least as many features as samples
+        rng = np.random.RandomState(42)
+        for n_samples, n_features in ((20, 30), (30, 30)):
+            X = rng.randn(n_samples, n_features)
+            clf = MCD(contamination=self.contamination, method='det')
+            clf.fit(X)
+            assert_equal(clf.raw_support_.sum(), n_samples)
+            assert_equal(len(clf.decision_scores_), n_samples)
+
+    def test_det_method_support_fraction(self):
+        for support_fraction in (0.75, 1.):
+            clf = MCD(contamination=self.contamination, method='det',
+                      support_fraction=support_fraction)
+            clf.fit(self.X_train)
+            assert_equal(clf.raw_support_.sum(),
+                         int(support_fraction * self.X_train.shape[0]))
+
+    def test_det_method_exact_fit(self):
+        # most samples are copies of a single point, so the covariance of
+        # the support is 0
+        rng = np.random.RandomState(42)
+        X = np.vstack([rng.randn(100, 2), np.tile([[1., 2.]], (200, 1))])
+        for method in ('fastmcd', 'det'):
+            with assert_raises(ValueError):
+                MCD(method=method, random_state=42).fit(X)
+
+    def test_det_method_consistency(self):
+        # the reweighted estimates are consistent at normal models
+        rng = np.random.RandomState(42)
+        cov = np.array([[2., 0.5, 0.], [0.5, 1., 0.], [0., 0., 0.5]])
+        X = rng.multivariate_normal(np.zeros(3), cov, size=5000)
+        clf = MCD(method='det').fit(X)
+
+        assert_allclose(clf.location_, np.zeros(3), atol=0.1)
+        assert_allclose(clf.covariance_, cov, atol=0.1)
+        assert_allclose(clf.raw_covariance_, cov, atol=0.15)
+
+    def test_c_steps_batched(self):
+        # the batched C-steps match running each subset on its own
+        rng = np.random.RandomState(42)
+        n_support = 120
+        supports = np.array([rng.choice(self.n_train, 100, replace=False)
+                             for _ in range(6)])
+        locations, covariances, final_supports, dists, logdets = _c_steps(
+            self.X_train, supports, n_support, False, max_iter=100, tol=0.)
+
+        for k in range(len(supports)):
+            location, covariance, support, logdet = _c_step_reference(
+                self.X_train, supports[k], n_support)
+            assert_allclose(locations[k], location)
+            assert_allclose(covariances[k], covariance)
+            assert_equal(np.sort(final_supports[k]), np.sort(support))
+            assert_allclose(logdets[k], logdet)
+
+    def test_c_steps_early_exit(self):
+        rng = np.random.RandomState(42)
+        n_support = 120
+        supports = np.array([rng.choice(self.n_train, 100, replace=False)
+                             for _ in range(6)])
+
+        def _logdets(**kwargs):
+            return _c_steps(self.X_train, supports, n_support, False,
+                            **kwargs)[4]
+
+        logdets_full = _logdets(max_iter=100, tol=0.)
+        logdets_first = _logdets(max_iter=1)
+
+        # C-steps never increase the determinant, so stopping early lands
+        # between the first C-step and the fully converged determinant
+        for tol in (1e-8, 1e-2, 0.5):
+            logdets_early = _logdets(max_iter=100, tol=tol)
+            assert_array_less(logdets_full - 1e-12, logdets_early)
+            assert_array_less(logdets_early, logdets_first + 1e-12)
+
+        # and with the default tolerance, at the converged determinant
+        assert_allclose(_logdets(), logdets_full, rtol=1e-6)
+
+    def test_method_parameter(self):
+        with assert_raises(ValueError):
+            MCD(method='something').fit(self.X_train)
+
     def test_prediction_labels(self):
         pred_labels = self.clf.predict(self.X_test)
         assert_equal(pred_labels.shape, self.y_test.shape)